@@ -5,23 +5,79 @@ import os
 import sys
 from typing import TYPE_CHECKING
 import asyncio
+import logging
+import logging.handlers
+import queue
 
 import discord
 from discord.ext import commands
 from PIL import Image
 
-import config
-
 if TYPE_CHECKING:
     from main import Context, Bot
 else:
     Context = None
     Bot = None
 
+IGNORED_ERRORS = (
+    commands.CommandNotFound,
+    commands.NotOwner,
+    commands.CheckFailure
+)
+
+ARGUMENT_ERRORS = (
+    commands.ConversionError,
+    commands.BadArgument,
+    commands.ArgumentParsingError,
+    commands.MissingRequiredArgument
+)
+
+CWD = os.getcwd()
+HOME = os.environ.get("USERPROFILE", "") if os.name == "nt" else ""
+
+# How many frames to keep from each end of a traceback
+TRACE_FRAMES = 5
+
+# Discord rejects embeds with longer field values
+FIELD_LIMIT = 1024
+
+# Unhandled errors are reported here, and written to stderr from a background thread
+ERROR_LOG = logging.getLogger("titanium.errors")
+ERROR_LOG.propagate = False
+
+def format_trace(tb) -> str:
+    # extract_tb keeps column positions, and only looks up source lines for the frames it returns
+    if sum(1 for _ in traceback.walk_tb(tb)) > 2 * TRACE_FRAMES:
+        lines = traceback.extract_tb(tb, limit=TRACE_FRAMES).format()
+        lines.append("...\n")
+        lines.extend(traceback.extract_tb(tb, limit=-TRACE_FRAMES).format())
+    else:
+        lines = traceback.extract_tb(tb).format()
+    trace = '\n'.join(lines).replace(CWD, os.path.curdir)
+    if HOME:
+        trace = trace.replace(HOME, "")
+    return trace
+
+def encode_png(im: Image.Image) -> bytes:
+    buf = io.BytesIO()
+    im.save(buf, format="PNG")
+    return buf.getvalue()
+
 class CommandCog(commands.Cog):
     def __init__(self, bot: Bot):
         self.bot = bot
         print("Loading commands...")
+        # Hand reports off to a queue, so a stalled stderr can't hold up the event loop or any replies
+        error_queue = queue.SimpleQueue()
+        self.error_handler = logging.handlers.QueueHandler(error_queue)
+        self.error_listener = logging.handlers.QueueListener(error_queue, logging.StreamHandler(sys.stderr))
+        ERROR_LOG.addHandler(self.error_handler)
+        self.error_listener.start()
+
+    def cog_unload(self):
+        # The logger outlives reloads, so this cog's handler has to be taken off of it
+        ERROR_LOG.removeHandler(self.error_handler)
+        self.error_listener.stop()
 
     @commands.command(aliases=["e", "el", "elem", "t", "tab", "table"])
     async def element(self, ctx: Context, *, query: str | None = None):
@@ -30,15 +86,10 @@ class CommandCog(commands.Cog):
         Specifying no element will show the entire table.
         """
         async with ctx.typing():
-            query = query.strip()
-            if query is None:
-                query = "normal"
+            query = "normal" if query is None else query.strip()
             if query in self.bot.tables:
                 emb = discord.Embed()
-                buf = io.BytesIO()
-                self.bot.tables[query].save(buf, format="PNG")
-                buf.seek(0)
-                file = discord.File(buf, "table.png")
+                file = discord.File(io.BytesIO(self.bot.table_pngs[query]), "table.png")
                 emb.set_image(url="attachment://table.png")
                 return await ctx.reply(embed=emb, files=[file])
             genderswapped = False
@@ -47,24 +98,20 @@ class CommandCog(commands.Cog):
                 genderswapped = True
             # Parse the element's name
             query = query.lower()
-            if query in self.bot.elements_by_name:
-                element = self.bot.elements_by_name[query]
-            elif query in self.bot.elements_by_symbol:
-                element = self.bot.elements_by_symbol[query]
-            elif (
-                query.isascii() and
-                query.isdecimal() and
-                len(query) > 0 and
-                (atomic_number := int(query)) in self.bot.elements_by_atomic_number
-            ):
-                element = self.bot.elements_by_atomic_number[atomic_number]
-            else:
-                query = query.replace("`", "").replace("\n", "")[:32]
-                return await ctx.error(f"No element found with name, symbol, or atomic number `{query}`!")   
+            element = self.bot.element_index.get(query)
+            if element is None:
+                # Catch atomic numbers that aren't written canonically, like 007
+                try:
+                    element = self.bot.elements_by_atomic_number[int(query)]
+                except (ValueError, KeyError):
+                    query = query.replace("`", "").replace("\n", "")[:32]
+                    return await ctx.error(f"No element found with name, symbol, or atomic number `{query}`!")
 
-            icon = self.bot.get_element_icon(element, genderswapped)
-            width, height = icon.size
-            icon = icon.resize((width * config.icon_scale, height * config.icon_scale), Image.Resampling.NEAREST)
+            png = element.icon_pngs.get(genderswapped)
+            if png is None:
+                png = element.icon_pngs[genderswapped] = await asyncio.to_thread(encode_png, element.icons[genderswapped])
+                # The PNG is all that's sent from now on, so don't hold onto the full-size bitmap
+                element.icons.pop(genderswapped, None)
 
             emb = discord.Embed (
                 color=element.embed_color,
@@ -73,20 +120,11 @@ class CommandCog(commands.Cog):
             emb.add_field(name="Symbol", value=element.symbol)
             if element.atomic_number is not None:
                 emb.add_field(name="Atomic Number", value=element.atomic_number)
-            pronouns = element.pronouns
-            if genderswapped and "/" in pronouns:
-                parts = pronouns.split("/")
-                table = {"he": "she", "him": "her", "she": "he", "her": "him", "hse": "eh", "ehr": "ihm", "him...?": "her...?"}
-                pronouns = "/".join(table.get(part, part) for part in parts)
+            pronouns = element.genderswapped_pronouns if genderswapped else element.pronouns
             emb.add_field(name="Pronouns", value=pronouns)
             emb.add_field(name="Author", value=element.author, inline = False)
-            buf = io.BytesIO()
-            icon.save(buf, format = "PNG")
-            buf.seek(0)
-            raw_name = element.name.replace(" ", "")
-            path = f"{raw_name}.png"
-            emb.set_image(url=f"attachment://{path}")
-            file = discord.File(buf, path)
+            emb.set_image(url=f"attachment://{element.filename}")
+            file = discord.File(io.BytesIO(png), element.filename)
             return await ctx.reply(embed=emb, files=[file])
 
     @commands.command()
@@ -105,7 +143,8 @@ class CommandCog(commands.Cog):
     @toml.command()
     async def get(self, ctx: Context):
         """Sends elements.toml."""
-        return await ctx.reply(files = [discord.File("elements.toml")])
+        data = await asyncio.to_thread(Path("elements.toml").read_bytes)
+        return await ctx.reply(files = [discord.File(io.BytesIO(data), "elements.toml")])
     
     @commands.is_owner()
     async def set(self, ctx: Context, attachment: discord.Attachment):
@@ -118,7 +157,7 @@ class CommandCog(commands.Cog):
     async def sync(self, ctx: Context):
         """Syncs the table to the bot. Owner-only."""
         async with ctx.typing():
-            self.bot.sync_image()
+            await self.bot.sync_image()
             self.bot.load_elements()
             return await ctx.reply("Synced image!")
 
@@ -129,12 +168,7 @@ class CommandCog(commands.Cog):
             if hasattr(ctx.command, 'on_error'):
                 return
 
-            ignored = (
-                commands.CommandNotFound,
-                commands.NotOwner,
-                commands.CheckFailure
-            )
-            if isinstance(error, ignored):
+            if isinstance(error, IGNORED_ERRORS):
                 return
 
             # Allows us to check for original exceptions raised and sent to CommandInvokeError.
@@ -142,53 +176,6 @@ class CommandCog(commands.Cog):
             # on_command_error.
             error = getattr(error, 'original', error)
 
-            emb = discord.Embed(title="Command Error", color=0xffff00)
-            emb.description = str(error)
-
-            # Adds embed fields
-            # Bot
-            if self.bot.user:  # tautology but fits the scheme
-                message_id = self.bot.user.id
-                name = self.bot.user.display_name
-            # Message
-            if ctx.message:
-                message_id = ctx.message.id
-                content = ctx.message.content
-                if len(content) > 1024:
-                    content = content[1000] + "`...`"
-                formatted = f"ID: {message_id}\nContent: `{content}`"
-                emb.add_field(name="Message", value=formatted)
-            # Channel
-            if isinstance(ctx.channel, discord.TextChannel):
-                message_id = ctx.channel.id
-                name = ctx.channel.name
-                nsfw = "[NSFW Channel] " if ctx.channel.is_nsfw() else ""
-                news = "[News Channel] " if ctx.channel.is_news() else ""
-                formatted = f"message_id: {message_id}\nName: {name}\n{nsfw}{news}"
-                emb.add_field(name="Channel", value=formatted)
-            # Guild (if in a guild)
-            if ctx.guild is not None:
-                ID = ctx.guild.id
-                name = ctx.guild.name
-                member_count = ctx.guild.member_count
-                formatted = f"ID: {ID}\nName: {name}\nMember count: {member_count}"
-                emb.add_field(name="Guild", value=formatted)
-            # Author (DM information if any)
-            if ctx.author:
-                ID = ctx.author.id
-                name = ctx.author.name
-                discriminator = ctx.author.discriminator
-                nick = f"({ctx.author.nick})" if ctx.guild else ""
-                DM = "Message Author" if ctx.guild else "Direct Message"
-                formatted = f"ID: {ID}\nName: {name}#{discriminator} ({nick})"
-                emb.add_field(name=DM, value=formatted)
-            # Message link
-            if all([ctx.guild is not None, ctx.channel, ctx.message]):
-                guild_ID = ctx.guild.id
-                channel_ID = ctx.channel.id
-                message_ID = ctx.message.id
-                formatted = f"[Jump to message](https://discordapp.com/channels/{guild_ID}/{channel_ID}/{message_ID})"
-                emb.add_field(name="Jump", value=formatted)
             if isinstance(error, commands.CommandOnCooldown):
                 if ctx.author.id == self.bot.owner_id:
                     return await ctx.reinvoke()
@@ -207,14 +194,10 @@ class CommandCog(commands.Cog):
             elif isinstance(error, commands.UnexpectedQuoteError):
                 return await ctx.error(f"Got unexpected quotation mark `{error.quote}` inside a string.")
 
-            elif \
-                isinstance(error, commands.ConversionError) \
-                or isinstance(error, commands.BadArgument) \
-                or isinstance(error, commands.ArgumentParsingError) \
-                or isinstance(error, commands.MissingRequiredArgument):
+            elif isinstance(error, ARGUMENT_ERRORS):
                 return await ctx.error("Command arguments were invalid! Check the entry in `.help` for the correct format.")
 
-            elif isinstance(error, AssertionError) or isinstance(error, NotImplementedError):
+            elif isinstance(error, (AssertionError, NotImplementedError)):
                 return await ctx.error(error.args[0])
 
             elif isinstance(error, discord.errors.HTTPException):
@@ -222,20 +205,9 @@ class CommandCog(commands.Cog):
             else:
                 raise error
         except Exception as error:
-            if os.name == "nt":
-                trace = '\n'.join(
-                    traceback.format_tb(
-                        error.__traceback__)).replace(
-                    os.getcwd(),
-                    os.path.curdir).replace(
-                    os.environ["USERPROFILE"],
-                    "")
-            else:
-                trace = '\n'.join(
-                    traceback.format_tb(
-                        error.__traceback__)).replace(
-                    os.getcwd(),
-                    os.path.curdir)
+            # Log first, so the report is kept even if building or sending the embed fails
+            ERROR_LOG.error("Ignoring exception in command %s:", ctx.command, exc_info=error)
+            trace = format_trace(error.__traceback__)
             if len(trace) > 1000:
                 trace = trace[:500] + "\n\n...\n\n" + trace[-500:] 
             title = f'**Unhandled exception!**'
@@ -248,15 +220,49 @@ class CommandCog(commands.Cog):
                 description=err_desc,
                 color=15029051
             )
+            # Adds context about where the error happened
+            # Message
+            if ctx.message:
+                message_id = ctx.message.id
+                content = ctx.message.content
+                formatted = f"ID: {message_id}\nContent: `{content}`"
+                if len(formatted) > FIELD_LIMIT:
+                    # Cut the content so that the whole field, suffix included, still fits
+                    content = content[:len(content) - (len(formatted) - FIELD_LIMIT) - len("`...`")] + "`...`"
+                    formatted = f"ID: {message_id}\nContent: `{content}`"
+                emb.add_field(name="Message", value=formatted)
+            # Channel
+            if isinstance(ctx.channel, discord.TextChannel):
+                ID = ctx.channel.id
+                name = ctx.channel.name
+                nsfw = "[NSFW Channel] " if ctx.channel.is_nsfw() else ""
+                news = "[News Channel] " if ctx.channel.is_news() else ""
+                formatted = f"ID: {ID}\nName: {name}\n{nsfw}{news}"
+                emb.add_field(name="Channel", value=formatted)
+            # Guild (if in a guild)
+            if ctx.guild is not None:
+                ID = ctx.guild.id
+                name = ctx.guild.name
+                member_count = ctx.guild.member_count
+                formatted = f"ID: {ID}\nName: {name}\nMember count: {member_count}"
+                emb.add_field(name="Guild", value=formatted)
+            # Author (DM information if any)
+            if ctx.author:
+                ID = ctx.author.id
+                name = ctx.author.name
+                discriminator = ctx.author.discriminator
+                nick = f" ({ctx.author.nick})" if ctx.guild and ctx.author.nick else ""
+                DM = "Message Author" if ctx.guild else "Direct Message"
+                formatted = f"ID: {ID}\nName: {name}#{discriminator}{nick}"
+                emb.add_field(name=DM, value=formatted)
+            # Message link
+            if all([ctx.guild is not None, ctx.channel, ctx.message]):
+                guild_ID = ctx.guild.id
+                channel_ID = ctx.channel.id
+                message_ID = ctx.message.id
+                formatted = f"[Jump to message](https://discordapp.com/channels/{guild_ID}/{channel_ID}/{message_ID})"
+                emb.add_field(name="Jump", value=formatted)
             await ctx.error(msg='', embed=emb)
-            print(
-                f'Ignoring exception in command {ctx.command}:',
-                file=sys.stderr)
-            traceback.print_exception(
-                type(error),
-                error,
-                error.__traceback__,
-                file=sys.stderr)
 
 async def setup(bot: Bot):
     await bot.add_cog(CommandCog(bot))
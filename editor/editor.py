@@ -8,13 +8,35 @@ import glfw
 from dataclasses import dataclass, field
 import tomllib
 from typing import Self
-import math
+from functools import cached_property
 import uuid
-import io
+import numpy as np
 
 TOOLBAR_HEIGHT: int = 26
 
-@dataclass
+TABLE_ELEMENT_TEMPLATE = """["{name}"]
+table = "{table}"
+symbol = "{symbol}"
+pronouns = "{pronouns}"
+author = "{author}"
+embed_color = 0x{embed_color:06X}
+coordinates = {{ x = {x}, y = {y} }}
+"""
+
+EXTRA_ELEMENT_TEMPLATE = """["{name}"]
+symbol = "{symbol}"
+pronouns = "{pronouns}"
+author = "{author}"
+embed_color = 0x{embed_color:06X}
+"""
+
+SUBSCRIPT_TO_ASCII = str.maketrans("₀₁₂₃₄₅₆₇₈₉•×", "0123456789+@")
+ASCII_TO_SUBSCRIPT = str.maketrans("0123456789+@", "₀₁₂₃₄₅₆₇₈₉•×")
+
+def escape(string: str) -> str:
+    return string.replace("\\", "\\\\").replace('"', '\\"')
+
+@dataclass(slots = True)
 class Point:
     x: int = 0
     y: int = 0
@@ -54,7 +76,27 @@ class Element:
     embed_color: int
     atomic_number: int | None
     coordinates: Point | None
-    uuid: str = field(default_factory = uuid.uuid4)
+    uuid: str = field(default_factory = lambda: uuid.uuid4().hex)
+    # (r, g, b, outline color, hover color), cleared whenever embed_color changes
+    color_cache: tuple[float, float, float, int, int] | None = field(default = None, repr = False)
+    author_label_cache: list[tuple[str, str]] = field(default_factory = list, repr = False)
+
+    @cached_property
+    def labels(self) -> dict[str, str]:
+        return {
+            "name": f"Name##{self.uuid}",
+            "symbol": f"Symbol##{self.uuid}",
+            "pronouns": f"Pronouns##{self.uuid}",
+            "embed_color": f"Embed Color##{self.uuid}",
+            "atomic_number": f"##Atomic Number##{self.uuid}",
+        }
+
+    # The (input, remove button) labels for the first `count` authors
+    def author_labels(self, count: int) -> list[tuple[str, str]]:
+        labels = self.author_label_cache
+        for i in range(len(labels), count):
+            labels.append((f"##{self.uuid}.{i}.author", f"-##{self.uuid}.{i}"))
+        return labels
 
 CAMERA_DAMPING = 0.001
 CAMERA_SPEED = 10000
@@ -75,6 +117,8 @@ class Camera:
     easing_time: float = 0
     easing_start: Point | None = None
     easing_target: Point | None = None
+    # Frame times barely vary, so the per-frame decay factors are cached by dt in 0.1ms steps
+    decay_cache: dict[int, tuple[float, float]] = field(default_factory = dict, repr = False)
 
     def ease_to(self, pos: Point):
         self.vel = Point()
@@ -88,11 +132,17 @@ class Camera:
         self.vel = (self.pos - self.last_pos) / self.last_dt
 
     def tick(self, dt: float):
-        self.zoom += (self.target_zoom - self.zoom) * (1 - ZOOM_EXP ** (-ZOOM_DECAY * dt))
-        self.last_pos = self.pos
+        key = int(dt * 10000)
+        factors = self.decay_cache.get(key)
+        if factors is None:
+            factors = self.decay_cache[key] = (1 - ZOOM_EXP ** (-ZOOM_DECAY * dt), CAMERA_DAMPING ** dt)
+        zoom_factor, damping = factors
+        self.zoom += (self.target_zoom - self.zoom) * zoom_factor
+        pos, vel, accel = self.pos, self.vel, self.accel
+        self.last_pos.x, self.last_pos.y = pos.x, pos.y
         self.last_dt = dt
         if self.easing_target is not None:
-            self.accel = Point()
+            accel.x = accel.y = 0
             if self.easing_time > EASING_TIME:
                 self.pos = self.easing_target
                 self.easing_target = None
@@ -101,17 +151,65 @@ class Camera:
             self.pos = self.easing_start + (self.easing_target - self.easing_start) * (1 - 2 ** (-10 * self.easing_time / EASING_TIME))
             self.easing_time += dt
             return
-        self.pos += self.vel * dt
-        self.vel += self.accel * dt
-        self.vel *= CAMERA_DAMPING ** dt
+        pos.x += vel.x * dt
+        pos.y += vel.y * dt
+        vel.x += accel.x * dt
+        vel.y += accel.y * dt
+        vel.x *= damping
+        vel.y *= damping
+
+# Where an element's outline sits within its cell, as [left, top, right, bottom]
+RECT_OFFSETS = np.array((0.5, 0.5, 47.5, 47.5))
 
 @dataclass
 class Table:
     image: int
-    actual_image: Image.Image
+    pixels: np.ndarray
     size: Point
     path: str
     elements: list[Element]
+    # Contiguous copies of the element coordinates and outlines, built on first use
+    # and then kept in step by add, remove, and update
+    coords_cache: np.ndarray | None = field(default = None, repr = False)
+    rects_cache: np.ndarray | None = field(default = None, repr = False)
+
+    def coords(self) -> np.ndarray:
+        if self.coords_cache is None:
+            self.coords_cache = np.array(
+                [element.coordinates.tup for element in self.elements],
+                dtype = np.int32
+            ).reshape(-1, 2)
+        return self.coords_cache
+
+    # The world-space outline of each element, as rows of [left, top, right, bottom]
+    def rects(self) -> np.ndarray:
+        if self.rects_cache is None:
+            self.rects_cache = (self.coords()[:, [0, 1, 0, 1]] + RECT_OFFSETS).astype(np.float32)
+        return self.rects_cache
+
+    def add(self, element: Element):
+        self.elements.append(element)
+        coords = np.array([element.coordinates.tup], dtype = np.int32)
+        if self.coords_cache is not None:
+            self.coords_cache = np.concatenate((self.coords_cache, coords))
+        if self.rects_cache is not None:
+            rect = (coords[:, [0, 1, 0, 1]] + RECT_OFFSETS).astype(np.float32)
+            self.rects_cache = np.concatenate((self.rects_cache, rect))
+
+    def remove(self, index: int):
+        del self.elements[index]
+        if self.coords_cache is not None:
+            self.coords_cache = np.delete(self.coords_cache, index, axis = 0)
+        if self.rects_cache is not None:
+            self.rects_cache = np.delete(self.rects_cache, index, axis = 0)
+
+    # Call after moving the element at index
+    def update(self, index: int):
+        coords = self.elements[index].coordinates
+        if self.coords_cache is not None:
+            self.coords_cache[index] = (coords.x, coords.y)
+        if self.rects_cache is not None:
+            self.rects_cache[index] = (coords.x, coords.y, coords.x, coords.y) + RECT_OFFSETS
 
 class Editor:
     tables: dict[str, Table]
@@ -136,8 +234,14 @@ class Editor:
         self.camera = Camera()
         self.dragging = False
         self.was_dragging = False
+        self.drag_element = None
+        self.drag_index = 0
         self.colorpicking = False
+        self.hover_fill = imgui.get_color_u32_rgba(1, 1, 1, 0.2)
+
 
+        # Texture rows are tightly packed, so don't rely on the default 4-byte alignment
+        gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
 
         # Load elements.toml
         with open("../elements.toml", "rb") as f:
@@ -145,8 +249,9 @@ class Editor:
         tex_ids = gl.glGenTextures(len(toml["tables"]))
         for (name, path), tex_id in zip(toml["tables"].items(), tex_ids):
             with Image.open(Path("..") / "elements" / path) as im:
-                self.create_image(im, tex_id)
-                self.tables[name] = Table (tex_id, im.convert("RGB"), Point(*im.size), path, [])
+                rgba = im if im.mode == "RGBA" else im.convert("RGBA")
+                self.create_image(rgba, tex_id)
+                self.tables[name] = Table (tex_id, np.asarray(rgba)[..., :3], Point(*im.size), path, [])
         del toml["tables"]
         
         for name, data in toml.items():
@@ -200,26 +305,21 @@ class Editor:
             if key == glfw.KEY_BACKSLASH and action == glfw.PRESS:
                 self.colorpicking = True
             if key == glfw.KEY_ENTER and action == glfw.PRESS:
-                self.table.elements.append(Element(
+                self.table.add(Element(
                     "",
                     "",
                     "",
                     [],
                     0xFF0000,
                     None,
-                    self.camera.pos
+                    self.camera.pos.floor()
                 ))
         return cb
 
     def move_to_el(self, offset: int):
-        min_dist = math.inf
-        min_el = None
-        for i, el in enumerate(self.table.elements):
-            diff = el.coordinates - (self.camera.pos if self.camera.easing_target is None else self.camera.easing_target)
-            dist = math.sqrt(diff.x ** 2 + diff.y ** 2)
-            if dist < min_dist:
-                min_dist = dist
-                min_el = i
+        ref = self.camera.pos if self.camera.easing_target is None else self.camera.easing_target
+        # The closest element by squared distance is also the closest by distance
+        min_el = int(((self.table.coords() - ref.tup) ** 2).sum(1).argmin())
         target_id = (min_el + offset) % len(self.table.elements)
         print(f"Closest to {min_el}, moving to {target_id}")
         target_el = self.table.elements[target_id]
@@ -232,6 +332,10 @@ class Editor:
         if glfw.window_should_close(self.window):
             self.running = False
             return
+        if glfw.get_window_attrib(self.window, glfw.ICONIFIED):
+            # Nothing would be visible, so wait for events instead of drawing
+            glfw.wait_events_timeout(0.1)
+            return
         glfw.poll_events()
         self.impl.process_inputs()
 
@@ -271,29 +375,30 @@ class Editor:
             imgui.end()
 
     def create_image(self, im, tex_id):
-        texture_data = im.convert("RGBA").tobytes()
+        if im.mode != "RGBA":
+            im = im.convert("RGBA")
+        texture_data = im.tobytes()
         # Bind and set the texture at the id
         gl.glBindTexture(gl.GL_TEXTURE_2D, tex_id)
-        gl.glClearColor(0, 0, 0, 0)
-        gl.glClear(gl.GL_COLOR_BUFFER_BIT)
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_NEAREST)
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_NEAREST)
-        gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGBA, im.size[0], im.size[1], 0, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, texture_data)
+        gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGBA8, im.size[0], im.size[1], 0, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, texture_data)
 
-    def world_to_screen(self, coord: Point, size: Point) -> Point:
-        return size / 2 - Point(self.camera.pos.x - coord.x,  self.camera.pos.y - coord.y) * self.camera.zoom
+    def world_to_screen(self, x: float, y: float, width: float, height: float) -> tuple[float, float]:
+        pos, zoom = self.camera.pos, self.camera.zoom
+        return (width / 2 - (pos.x - x) * zoom, height / 2 - (pos.y - y) * zoom)
 
-    def screen_to_world(self, coord: Point, size: Point) -> Point:
-        return Point(self.camera.pos.x, self.camera.pos.y) - (size / 2 - coord) / self.camera.zoom
+    def screen_to_world(self, x: float, y: float, width: float, height: float) -> tuple[float, float]:
+        pos, zoom = self.camera.pos, self.camera.zoom
+        return (pos.x - (width / 2 - x) / zoom, pos.y - (height / 2 - y) / zoom)
 
     def main_interface(self):
-        screen_mouse = Point(*self.io.mouse_pos)
-        main_size = Point(*imgui.get_content_region_available())
-        world_mouse = self.screen_to_world(screen_mouse, main_size)
+        main_w, main_h = imgui.get_content_region_available()
+        mouse_x, mouse_y = self.screen_to_world(*self.io.mouse_pos, main_w, main_h)
 
-        if self.colorpicking and world_mouse.within(Point(), Point(*self.table.actual_image.size)):
-            print(f"Mouse position: {world_mouse}")
-            r, g, b = self.table.actual_image.getpixel((world_mouse.x, world_mouse.y)) 
+        if self.colorpicking and 0 <= mouse_x < self.table.size.x and 0 <= mouse_y < self.table.size.y:
+            print(f"Mouse position: {mouse_x}, {mouse_y}")
+            r, g, b = (int(channel) for channel in self.table.pixels[int(mouse_y), int(mouse_x)])
             imgui.set_clipboard_text(f"#{r << 16 | g << 8 | b:06X}")
             self.colorpicking = False
         
@@ -301,94 +406,122 @@ class Editor:
         
         draw_list.add_image(
             self.table.image, 
-            self.world_to_screen(Point(), main_size).tup,
-            self.world_to_screen(self.table.size, main_size).tup,
+            self.world_to_screen(0, 0, main_w, main_h),
+            self.world_to_screen(self.table.size.x, self.table.size.y, main_w, main_h),
         )
 
         just_started_dragging = False
 
         none_within = True
 
-        for element in self.table.elements:
-            top_left = element.coordinates + Point(0.5, 0.5)
-            bottom_right = element.coordinates + Point(47.5, 47.5)
-            within = world_mouse.within(top_left, bottom_right) and imgui.is_window_hovered()
-            r, g, b = element.embed_color.to_bytes(3, "big")
-            r, g, b = r / 255, g / 255, b / 255
-            if self.camera.zoom > 1.01 and not within:
-                draw_list.add_rect(
-                    *self.world_to_screen(top_left, main_size).tup,
-                    *self.world_to_screen(bottom_right, main_size).tup,
-                    imgui.get_color_u32_rgba(0, 0, 0, 0.1),
-                    thickness = self.camera.zoom
-                )
-                draw_list.add_rect(
-                    *self.world_to_screen(top_left, main_size).tup,
-                    *self.world_to_screen(bottom_right, main_size).tup,
-                    imgui.get_color_u32_rgba(1, 1, 1, 0.1),
-                    thickness = self.camera.zoom
-                )
-                draw_list.add_rect(
-                    *self.world_to_screen(top_left, main_size).tup,
-                    *self.world_to_screen(bottom_right, main_size).tup,
-                    imgui.get_color_u32_rgba(r, g, b, 0.6),
-                    thickness = self.camera.zoom
-                )
-            if within:
-                none_within = False
-                tl = top_left - Point(1, 1)
-                br = bottom_right + Point(1, 1)
-                draw_list.add_rect_filled(
-                    *self.world_to_screen(tl, main_size).tup,
-                    *self.world_to_screen(br, main_size).tup,
-                    imgui.get_color_u32_rgba(1, 1, 1, 0.2),
-                )
-                draw_list.add_rect(
-                    *self.world_to_screen(tl, main_size).tup,
-                    *self.world_to_screen(br, main_size).tup,
-                    imgui.get_color_u32_rgba(r, g, b, 1),
-                    thickness = self.camera.zoom
-                )
-                if imgui.is_mouse_clicked():
-                    self.active_element = element
-                if imgui.is_mouse_clicked(1) and not self.was_dragging:
-                    self.active_element = element
-                    self.dragging = True
-                    self.drag_offset = element.coordinates - world_mouse
-                    just_started_dragging = True
-        if imgui.is_window_hovered() and imgui.is_mouse_clicked() and none_within:
+        cam_x, cam_y = self.camera.pos.x, self.camera.pos.y
+        zoom = self.camera.zoom
+        half_w, half_h = main_w / 2, main_h / 2
+        hovered = imgui.is_window_hovered()
+        draw_outlines = zoom > 1.01
+        hover_fill = self.hover_fill
+        color = self.color
+        add_rect = draw_list.add_rect
+        add_rect_filled = draw_list.add_rect_filled
+
+        # Skip elements outside of the view, padded by a unit for the hover box and outline thickness
+        rects = self.table.rects()
+        view_w, view_h = half_w / zoom + 1, half_h / zoom + 1
+        visible = np.flatnonzero(
+            (rects[:, 2] >= cam_x - view_w) & (rects[:, 0] <= cam_x + view_w) &
+            (rects[:, 3] >= cam_y - view_h) & (rects[:, 1] <= cam_y + view_h)
+        )
+        rects = rects[visible]
+
+        # Project every outline to the screen at once: screen = world * zoom + (half size - camera * zoom)
+        offset_x, offset_y = half_w - cam_x * zoom, half_h - cam_y * zoom
+        screen_rects = (rects * zoom + np.array((offset_x, offset_y, offset_x, offset_y))).tolist()
+
+        # Hit-test the mouse against every visible element at once
+        hovered_index = -1
+        if hovered:
+            hit = (
+                (rects[:, 0] <= mouse_x) & (mouse_x < rects[:, 2]) &
+                (rects[:, 1] <= mouse_y) & (mouse_y < rects[:, 3])
+            )
+            if hit.any():
+                hovered_index = int(hit.argmax())
+
+        elements = self.table.elements
+        if draw_outlines:
+            for j, (i, screen_rect) in enumerate(zip(visible.tolist(), screen_rects)):
+                if j != hovered_index:
+                    add_rect(*screen_rect, color(elements[i])[3], thickness = zoom)
+
+        if hovered_index != -1:
+            none_within = False
+            i = int(visible[hovered_index])
+            element = elements[i]
+            hover_color = color(element)[4]
+            left, top, right, bottom = screen_rects[hovered_index]
+            add_rect_filled(left - zoom, top - zoom, right + zoom, bottom + zoom, hover_fill)
+            add_rect(left - zoom, top - zoom, right + zoom, bottom + zoom, hover_color, thickness = zoom)
+            if imgui.is_mouse_clicked():
+                self.active_element = element
+            if imgui.is_mouse_clicked(1) and not self.was_dragging:
+                self.active_element = element
+                self.dragging = True
+                self.drag_offset = Point(element.coordinates.x - mouse_x, element.coordinates.y - mouse_y)
+                self.drag_element = element
+                self.drag_index = i
+                just_started_dragging = True
+        if hovered and imgui.is_mouse_clicked() and none_within:
             self.active_element = None
         self.was_dragging = self.dragging
         if self.dragging and not just_started_dragging:
-            if self.active_element is None or imgui.is_mouse_clicked(1):
+            # drag_index is only valid for the element the drag started on, so stop if the selection moves on
+            if self.active_element is not self.drag_element or imgui.is_mouse_clicked(1):
                 self.dragging = False
             else:
-                self.active_element.coordinates = (world_mouse + self.drag_offset).floor()
+                coords = self.active_element.coordinates
+                coords.x = int(mouse_x + self.drag_offset.x)
+                coords.y = int(mouse_y + self.drag_offset.y)
+                self.table.update(self.drag_index)
+
+    def color(self, element: Element) -> tuple[float, float, float, int, int]:
+        if element.color_cache is None:
+            c = element.embed_color
+            r, g, b = (c >> 16 & 0xFF) / 255, (c >> 8 & 0xFF) / 255, (c & 0xFF) / 255
+            element.color_cache = (
+                r, g, b,
+                # The 10% black, 10% white, and 60% embed color outlines, composited into one
+                imgui.get_color_u32_rgba(
+                    (0.6 * r + 0.04) / 0.676,
+                    (0.6 * g + 0.04) / 0.676,
+                    (0.6 * b + 0.04) / 0.676,
+                    0.676
+                ),
+                imgui.get_color_u32_rgba(r, g, b, 1)
+            )
+        return element.color_cache
 
     def edit_interface(self):
-        changed, new_name = imgui.input_text(f"Name##{self.active_element.uuid}", self.active_element.name)
+        labels = self.active_element.labels
+        changed, new_name = imgui.input_text(labels["name"], self.active_element.name)
         if changed: self.active_element.name = new_name
-        old_symbol = self.active_element.symbol
-        for a, b in zip("₀₁₂₃₄₅₆₇₈₉•×", "0123456789+@"):
-            old_symbol = old_symbol.replace(a, b)
-        changed, new_symbol = imgui.input_text(f"Symbol##{self.active_element.uuid}", old_symbol)
+        old_symbol = self.active_element.symbol.translate(SUBSCRIPT_TO_ASCII)
+        changed, new_symbol = imgui.input_text(labels["symbol"], old_symbol)
         if changed: 
-            for a, b in zip("₀₁₂₃₄₅₆₇₈₉•×", "0123456789+@"):
-                new_symbol = new_symbol.replace(b, a)
-            self.active_element.symbol = new_symbol
-        changed, new_pronouns = imgui.input_text(f"Pronouns##{self.active_element.uuid}", self.active_element.pronouns)
+            self.active_element.symbol = new_symbol.translate(ASCII_TO_SUBSCRIPT)
+        changed, new_pronouns = imgui.input_text(labels["pronouns"], self.active_element.pronouns)
         if changed: self.active_element.pronouns = new_pronouns
-        r, g, b = self.active_element.embed_color.to_bytes(3, "big")
-        changed, new_color = imgui.color_edit3(f"Embed Color##{self.active_element.uuid}", r / 255, g / 255, b / 255)
+        r, g, b, _, _ = self.color(self.active_element)
+        changed, new_color = imgui.color_edit3(labels["embed_color"], r, g, b)
         if changed:
             r, g, b = new_color
             new_int = int(r * 255) << 16 | int(g * 255) << 8 | int(b * 255)
             self.active_element.embed_color = new_int
+            self.active_element.color_cache = None
         if imgui.checkbox("Atomic Number", self.active_element.atomic_number is not None)[1]:
             if self.active_element.atomic_number is None:
                 self.active_element.atomic_number = 0
             imgui.same_line()
-            changed, new_number = imgui.input_int(f"##Atomic Number##{self.active_element.uuid}", self.active_element.atomic_number)
+            changed, new_number = imgui.input_int(labels["atomic_number"], self.active_element.atomic_number)
             if changed: self.active_element.atomic_number = new_number
         else:
             self.active_element.atomic_number = None
@@ -396,11 +529,12 @@ class Editor:
         imgui.text(f"Authors")
         imgui.indent()
         author_list = []
-        for i, author in enumerate(self.active_element.authors):
-            changed, new_name = imgui.input_text(f"##{self.active_element.uuid}.{i}.author", author)
+        authors = self.active_element.authors
+        for author, (author_label, remove_label) in zip(authors, self.active_element.author_labels(len(authors))):
+            changed, new_name = imgui.input_text(author_label, author)
             if changed: author = new_name
             imgui.same_line()
-            if not imgui.button(f"-##{self.active_element.uuid}.{i}"):
+            if not imgui.button(remove_label):
                 author_list.append(author)
 
         if imgui.button("+"):
@@ -418,41 +552,44 @@ class Editor:
                     remove_id = i
                     self.active_element = None
                     break
-            del self.table.elements[remove_id]
+            self.table.remove(remove_id)
         imgui.pop_style_color(3)
     
     def save(self):
-        toml = io.StringIO()
-        toml.write(f"[tables]\n")
+        parts: list[str] = ["[tables]\n"]
         for table, table_data in self.tables.items():
-            toml.write(f'{table} = "{table_data.path}"\n')
+            parts.append(f'{table} = "{table_data.path}"\n')
         for table, table_data in self.tables.items():
-            toml.write(f"\n### {table} ###\n\n\n")
+            parts.append(f"\n### {table} ###\n\n\n")
             for element in table_data.elements:
-                toml.write(f'["{element.name}"]\n')
-                toml.write(f'table = "{table}"\n')
-                toml.write(f'symbol = "{element.symbol}"\n')
-                toml.write(f'pronouns = "{element.pronouns}"\n')
-                toml.write(f'author = "{", ".join(element.authors)}"\n')
-                toml.write(f'embed_color = 0x{element.embed_color:06X}\n')
-                toml.write(f'coordinates = {{ x = {element.coordinates.x}, y = {element.coordinates.y} }}\n')
+                parts.append(TABLE_ELEMENT_TEMPLATE.format(
+                    name = escape(element.name),
+                    table = table,
+                    symbol = escape(element.symbol),
+                    pronouns = escape(element.pronouns),
+                    author = escape(", ".join(element.authors)),
+                    embed_color = element.embed_color,
+                    x = element.coordinates.x,
+                    y = element.coordinates.y
+                ))
                 if element.atomic_number is not None:
-                    toml.write(f'atomic_number = {element.atomic_number}\n')
-                toml.write(f'\n')
-        toml.write(f"\n### extras ###\n\n\n")
+                    parts.append(f'atomic_number = {element.atomic_number}\n')
+                parts.append('\n')
+        parts.append("\n### extras ###\n\n\n")
         for (element, path) in self.extras:
-            toml.write(f'["{element.name}"]\n')
-            toml.write(f'symbol = "{element.symbol}"\n')
-            toml.write(f'pronouns = "{element.pronouns}"\n')
-            toml.write(f'author = "{", ".join(element.authors)}"\n')
-            toml.write(f'embed_color = 0x{element.embed_color:06X}\n')
+            parts.append(EXTRA_ELEMENT_TEMPLATE.format(
+                name = escape(element.name),
+                symbol = escape(element.symbol),
+                pronouns = escape(element.pronouns),
+                author = escape(", ".join(element.authors)),
+                embed_color = element.embed_color
+            ))
             if element.atomic_number is not None:
-                toml.write(f'atomic_number = {element.atomic_number}\n')
-            toml.write(f'path = "{path}"\n')
-            toml.write(f'\n')
+                parts.append(f'atomic_number = {element.atomic_number}\n')
+            parts.append(f'path = "{path}"\n\n')
         # We only do this now so that the toml isn't wiped out if something errors mid-write
         with open("../elements.toml", "w") as f:
-            f.write(toml.getvalue())
+            f.write("".join(parts))
 
     def menu_bar(self):
         if imgui.button("Save"):
@@ -19,14 +19,20 @@ def main():
     editor = Editor(window, impl)
     try:
         last_update = time.perf_counter()
-        dt = 1 / 60
+        next_frame = last_update + FRAME_TIME
+        dt = FRAME_TIME
         while editor.running:
             editor.main_loop(dt)
+            sleep_for = next_frame - time.perf_counter()
+            if sleep_for > 0:
+                time.sleep(sleep_for)
+                next_frame += FRAME_TIME
+            else:
+                # Don't try to catch up after a long frame
+                next_frame = time.perf_counter() + FRAME_TIME
             new_time = time.perf_counter()
             dt = new_time - last_update
             last_update = new_time
-            if dt < 1 / 60:
-                time.sleep(1 / 60 - dt)
     except Exception:  # Don't catch KeyboardInterrupt
         print("[FATAL EXCEPTION]")
         with open(Path(__file__).resolve().parent / "crashlog.txt", "w+") as f:
@@ -39,6 +45,7 @@ def main():
         glfw.terminate()
 
 WIDTH, HEIGHT = 1366, 768
+FRAME_TIME = 1 / 60
 WINDOW_NAME = "elements.toml editor"
 
 def init():
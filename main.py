@@ -3,22 +3,28 @@
 from __future__ import annotations
 
 import numpy as np
+import io
 import json
-import html.parser
-import urllib.request
-from typing import Callable, Self
-import tomllib
-from dataclasses import dataclass
+import html
+import re
+import asyncio
+from typing import Callable, Self, TYPE_CHECKING
+from functools import cached_property
+from dataclasses import dataclass, field
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
+import aiohttp
 import discord
 from discord.ext import commands
 from PIL import Image
-import pytumblr
 
 import config
 import auth
 
+if TYPE_CHECKING:
+    import pytumblr
+
 ELEMENT_SCHEMA: dict[str, type | dict[Self]] = {
     "symbol": str,
     "embed_color": int,
@@ -33,26 +39,59 @@ ELEMENT_SCHEMA_OPTIONAL: dict[str, type | dict[Self]] = {
     "table": str,
 }
 
-def check_schema(obj: dict, schema: dict, optional: dict | None = None) -> list[str]:
+def build_validator(schema: dict, optional: dict | None = None) -> Callable[[dict], list[str]]:
     optional = {} if optional is None else optional
-    keys = set(obj.keys())
-    schema_keys = set(schema.keys())
-    wrong = []
-    schema_optional_keys = set(optional.keys()) | schema_keys
-    if len(extra_keys := keys.difference(schema_optional_keys)):
-        wrong.append(f"Extraneous keys: `{extra_keys}`")
-    if len(missing_keys := schema_keys.difference(keys)):
-        wrong.append(f"Missing keys: `{missing_keys}`")
-    schema_or_opt = schema | optional
-    for key in keys.intersection(schema_optional_keys):
-        val = obj[key]
-        ty = schema_or_opt[key]
-        if isinstance(ty, type):
-            if not isinstance(val, ty):
-                wrong.append(f"Key of wrong type: `{key}` (expected `{ty.__name__}`)")
-        else:
-            wrong.extend(check_schema(val, ty))
-    return wrong
+    required = frozenset(schema)
+    # Each key maps to either its expected type, or a validator for its nested schema
+    checks: dict[str, type | Callable[[dict], list[str]]] = {
+        key: ty if isinstance(ty, type) else build_validator(ty)
+        for key, ty in (schema | optional).items()
+    }
+
+    def validate(obj: dict) -> list[str]:
+        wrong = []
+        if len(extra_keys := {key for key in obj if key not in checks}):
+            wrong.append(f"Extraneous keys: `{extra_keys}`")
+        if len(missing_keys := {key for key in required if key not in obj}):
+            wrong.append(f"Missing keys: `{missing_keys}`")
+        for key, val in obj.items():
+            check = checks.get(key)
+            if check is None:
+                continue
+            if isinstance(check, type):
+                if not isinstance(val, check):
+                    wrong.append(f"Key of wrong type: `{key}` (expected `{check.__name__}`)")
+            else:
+                wrong.extend(check(val))
+        return wrong
+
+    return validate
+
+validate_element = build_validator(ELEMENT_SCHEMA, ELEMENT_SCHEMA_OPTIONAL)
+
+# Replaced after "**n**", so a × can't form part of one
+SYMBOL_TO_ASCII = str.maketrans({
+    **dict(zip("₀₁₂₃₄₅₆₇₈₉", "0123456789")),
+    "ⓢ": "(s)",
+    "×": "*",
+})
+
+GENDERSWAPPED_PRONOUNS: dict[str, str] = {
+    "he": "she",
+    "him": "her",
+    "she": "he",
+    "her": "him",
+    "hse": "eh",
+    "ehr": "ihm",
+    "him...?": "her...?",
+}
+
+def scale_icon(icon: Image.Image, scale: int = config.icon_scale) -> Image.Image:
+    if icon.mode not in ("L", "RGB", "RGBA"):
+        # Palette and other modes don't survive the round trip through NumPy
+        width, height = icon.size
+        return icon.resize((width * scale, height * scale), Image.Resampling.NEAREST)
+    return Image.fromarray(np.asarray(icon).repeat(scale, 0).repeat(scale, 1))
 
 @dataclass
 class Element:
@@ -74,8 +113,39 @@ class Element:
     author: str
     """The author of the element's design."""
 
-    image: Image.Image | tuple[str, tuple[int, int]]
-    """The image, or table coordinates, of the element."""
+    image: Image.Image | None
+    """The image of the element, if it isn't on a table."""
+
+    table: str | None = None
+    """The table the element is on, if any."""
+
+    coordinates: tuple[int, int] | None = None
+    """The coordinates of the element on its table."""
+
+    raw_icons: dict[bool, Image.Image] = field(default_factory=dict, repr=False)
+    """The icon of the element, keyed by whether it's genderswapped."""
+
+    icons: dict[bool, Image.Image] = field(default_factory=dict, repr=False)
+    """The upscaled icon of the element, keyed by whether it's genderswapped. Dropped once encoded into `icon_pngs`."""
+
+    icon_pngs: dict[bool, bytes] = field(default_factory=dict, repr=False)
+    """The encoded, upscaled icon of the element, keyed by whether it's genderswapped."""
+
+    @cached_property
+    def filename(self) -> str:
+        """The filename the element's icon is attached as."""
+        return self.name.replace(" ", "") + ".png"
+
+    @cached_property
+    def genderswapped_pronouns(self) -> str:
+        """The element's pronouns, genderswapped."""
+        if "/" not in self.pronouns:
+            return self.pronouns
+        return "/".join(GENDERSWAPPED_PRONOUNS.get(part, part) for part in self.pronouns.split("/"))
+
+MESSAGE_LIMIT = 2000
+TRUNCATION_SUFFIX = " [...] \n\n (Character limit reached!)"
+TRUNCATED_LENGTH = MESSAGE_LIMIT - len(TRUNCATION_SUFFIX)
 
 class Context(commands.Context):
     silent: bool = False
@@ -92,12 +162,12 @@ class Context(commands.Context):
             return await self.reply(msg, **kwargs)
 
     async def send(self, content: str = "", embed: discord.Embed | None = None, **kwargs):
-        content = str(content)
+        if not isinstance(content, str):
+            content = str(content)
         kwargs['ephemeral'] = self.ephemeral
         kwargs['silent'] = self.silent
-        if len(content) > 2000:
-            msg = " [...] \n\n (Character limit reached!)"
-            content = content[:2000 - len(msg)] + msg
+        if len(content) > MESSAGE_LIMIT:
+            content = content[:TRUNCATED_LENGTH] + TRUNCATION_SUFFIX
         if embed is not None:
             if content:
                 return await super().send(content, embed=embed, **kwargs)
@@ -112,87 +182,109 @@ class Context(commands.Context):
         kwargs['ephemeral'] = self.ephemeral
         return await self.send(*args, **kwargs)
 
-class ImageScraper(html.parser.HTMLParser):
-    seen_image: bool = False
-    callback: Callable
+# Matches the srcset of the first image in a post
+IMAGE_SRCSET = re.compile(r'<img\b[^>]*\bsrcset="([^"]+)"', re.IGNORECASE)
 
-    def __init__(self, callback: Callable):
-        super().__init__()
-        self.seen_image = False
-        self.callback = callback
+def save_table_image(data: bytes):
+    buf = io.BytesIO()
+    with Image.open(io.BytesIO(data)) as im:
+        # The image is saved before the file closes, so there's no need to copy it first
+        (im if im.mode == "RGBA" else im.convert("RGBA")).save(buf, format="PNG")
+    png = buf.getvalue()
+    path = Path("elements") / "normal.png"
+    # Leave the file untouched if the table hasn't changed, so load_elements can skip reloading
+    if not path.exists() or path.read_bytes() != png:
+        path.write_bytes(png)
 
-    def reset(self):
-        super().reset()
-        self.seen_image = False
+def load_image(path: Path) -> Image.Image:
+    with Image.open(path) as im:
+        im.load()
+        return im
 
-    def handle_starttag(self, tag, attrs):
-        attrs = dict(attrs)
-        if tag == "img" and not self.seen_image:
-            src = attrs["srcset"].split(", ")[-1].split(" ")[0]
-            with urllib.request.urlopen(src) as f:
-                with Image.open(f) as im:
-                    (self.callback)(im.copy().convert("RGBA"))
-            self.seen_image = True
+def load_table(path: Path) -> tuple[bytes, np.ndarray]:
+    data = path.read_bytes()
+    with Image.open(io.BytesIO(data)) as im:
+        # Icons are cropped out of the table by slicing, so keep it as one contiguous RGBA array
+        return data, np.ascontiguousarray(im.convert("RGBA"))
+
+# Identifies the current state of every file that load_elements reads
+def element_sources_key() -> tuple[tuple[str, int, int], ...]:
+    paths = sorted([Path("elements.toml"), *Path("elements").iterdir()])
+    return tuple((str(path), (stat := path.stat()).st_mtime_ns, stat.st_size) for path in paths)
 
 class Bot(commands.Bot):
     client: pytumblr.TumblrRestClient
-    parser: ImageScraper
-    tables: dict[str, Image.Image]
+    tables: dict[str, np.ndarray]
+    table_pngs: dict[str, bytes]
     elements_by_atomic_number: dict[int, Element]
     elements_by_symbol: dict[str, Element]
     elements_by_name: dict[str, Element]
+    element_index: dict[str, Element]
+    icon_stack: np.ndarray | None
+    elements_key: tuple[tuple[str, int, int], ...] | None
 
     def __init__(self, *args, **kwargs):
         self.client = None
-        self.parser = None
         self.tables = {}
+        self.table_pngs = {}
         self.elements_by_atomic_number = {}
         self.elements_by_symbol = {}
         self.elements_by_name = {}
+        self.element_index = {}
+        self.icon_stack = None
+        self.elements_key = None
         super().__init__(*args, **kwargs)
 
-    async def on_ready(self):
-        if "commands" in self.extensions:
-            await self.unload_extension("commands")
+    # Runs once before connecting, unlike on_ready, which fires again on every reconnect
+    async def setup_hook(self):
         await self.load_extension("commands")
+        import pytumblr
         self.client = pytumblr.TumblrRestClient(
             auth.CONSUMER_KEY,
             auth.CONSUMER_SECRET,
             auth.OAUTH_TOKEN,
             auth.OAUTH_SECRET
         )
-        def cb(image: Image.Image):
-            nonlocal self
-            image.save("elements/normal.png")
-        self.parser = ImageScraper(cb)
-        self.sync_image()
+        await self.sync_image()
         self.load_elements()
+
+    async def on_ready(self):
         print("Ready!")
 
     def load_elements(self):
+        # Only used here
+        import tomllib
+
+        key = element_sources_key()
+        if key == self.elements_key:
+            print("Elements are unchanged!")
+            return
         print("Loading elements...")
-        self.elements_by_name = {}
-        self.elements_by_atomic_number = {}
-        self.elements_by_symbol = {}        
-    
         with open("elements.toml", "rb") as f:
             raw_elements = tomllib.load(f)
-        for name, path in raw_elements["tables"].items():
-            with Image.open(Path("elements") / path) as im:
-                im.load()
-                self.tables[name] = im
-        del raw_elements["tables"]
+        table_paths = raw_elements.pop("tables")
+        icon_paths = set()
         for name, raw_element in raw_elements.items():
-            things_wrong = check_schema(raw_element, ELEMENT_SCHEMA, ELEMENT_SCHEMA_OPTIONAL)
+            things_wrong = validate_element(raw_element)
             assert not len(things_wrong), f"Element `{name}` has a malformed entry!\n" + "\n".join(things_wrong)
             if "table" in raw_element:
                 assert "coordinates" in raw_element, F"Element `{name}` has a table, but no coordinates!"
-                image = (raw_element["table"], (raw_element["coordinates"]["x"], raw_element["coordinates"]["y"]))
             else:
                 assert "path" in raw_element, F"Element `{name}` has no table or path!"
-                with Image.open(Path("elements") / raw_element["path"]) as im:
-                    im.load()
-                    image = im
+                icon_paths.add(raw_element["path"])
+        # PNG decoding releases the GIL, so decode every image at once
+        with ThreadPoolExecutor() as pool:
+            tables = pool.map(load_table, [Path("elements") / path for path in table_paths.values()])
+            icons = dict(zip(icon_paths, pool.map(load_image, [Path("elements") / path for path in icon_paths])))
+            # Rebuilt rather than updated, so tables removed from elements.toml go away too
+            self.table_pngs = {}
+            self.tables = {}
+            for name, (data, arr) in zip(table_paths, tables):
+                # The tables are already PNGs, so keep the file around to send as-is
+                self.table_pngs[name] = data
+                self.tables[name] = arr
+        elements = []
+        for name, raw_element in raw_elements.items():
             element = Element(
                 name,
                 raw_element["symbol"],
@@ -200,43 +292,107 @@ class Bot(commands.Bot):
                 raw_element["pronouns"],
                 raw_element["embed_color"],
                 raw_element["author"],
-                image
+                icons.get(raw_element.get("path")),
+                raw_element.get("table"),
+                (raw_element["coordinates"]["x"], raw_element["coordinates"]["y"]) if "coordinates" in raw_element else None
             )
-            self.elements_by_name[name.lower()] = element
-            if element.atomic_number is not None:
-                self.elements_by_atomic_number[element.atomic_number] = element
-            if element.symbol != "???":
-                raw_symbol = element.symbol.lower()
-                for a, b in zip([*"₀₁₂₃₄₅₆₇₈₉", "ⓢ", "**n**", "×"], [*"0123456789", "(s)", "n", "*"]):
-                    raw_symbol = raw_symbol.replace(a, b)
-                self.elements_by_symbol[raw_symbol] = element
+            element.raw_icons[False] = self.crop_icon(element)
+            if element.table == "normal":
+                element.raw_icons[True] = self.crop_icon(element, True)
+            else:
+                element.raw_icons[True] = element.raw_icons[False]
+            elements.append(element)
+        self.elements_by_name = {element.name.lower(): element for element in elements}
+        self.elements_by_atomic_number = {
+            element.atomic_number: element
+            for element in elements
+            if element.atomic_number is not None
+        }
+        self.elements_by_symbol = {
+            element.symbol.lower().replace("**n**", "n").translate(SYMBOL_TO_ASCII): element
+            for element in elements
+            if element.symbol != "???"
+        }
         print("Generating Omnium...")        
-        omnium = np.array([self.get_element_icon(el).convert("RGB") for el in self.elements_by_atomic_number.values()], dtype=np.uint8)
-        omnium = np.average(omnium, axis = 0).astype(np.uint8)
-        omnium = Image.fromarray(omnium)
-        omnium_embed = np.array([(*el.embed_color.to_bytes(3, "big"), ) for el in self.elements_by_atomic_number.values()], dtype=np.uint8)
-        omnium_embed = np.average(omnium_embed, axis = 0).astype(int)
-        omnium_embed = int(omnium_embed[0]) << 16 | int(omnium_embed[1]) << 8 | int(omnium_embed[2])
+        numbered = list(self.elements_by_atomic_number.values())
+        width, height = self.get_element_icon(numbered[0]).size
+        self.icon_stack = np.empty((len(numbered), height, width, 3), dtype=np.uint8)
+        for i, el in enumerate(numbered):
+            icon = self.get_element_icon(el)
+            if icon.mode not in ("RGB", "RGBA"):
+                icon = icon.convert("RGB")
+            # Converting RGBA to RGB only drops the alpha channel, so do that while copying instead
+            self.icon_stack[i] = np.frombuffer(icon.tobytes(), np.uint8).reshape(height, width, len(icon.getbands()))[..., :3]
+        # Sum in the narrowest type that can't overflow, since the sum is memory-bound
+        acc_dtype = np.uint16 if len(numbered) * 255 <= np.iinfo(np.uint16).max else np.uint32
+        omnium = self.icon_stack.sum(axis=0, dtype=acc_dtype) // len(numbered)
+        omnium = Image.fromarray(omnium.astype(np.uint8))
+        colors = np.fromiter(
+            (el.embed_color for el in self.elements_by_atomic_number.values()),
+            dtype=np.uint32,
+            count=len(self.elements_by_atomic_number)
+        )
+        omnium_embed = (
+            int(((colors >> 16) & 0xFF).mean()) << 16 |
+            int(((colors >> 8) & 0xFF).mean()) << 8 |
+            int((colors & 0xFF).mean())
+        )
         omnium = Element("Omnium", "???", None, "any/all", omnium_embed, "@everyone", omnium)
+        omnium.raw_icons[False] = omnium.raw_icons[True] = omnium.image
         self.elements_by_name["omnium"] = omnium
+        # Later entries take priority, so names win over symbols, and symbols over atomic numbers
+        self.element_index = {
+            **{str(number): element for number, element in self.elements_by_atomic_number.items()},
+            **self.elements_by_symbol,
+            **self.elements_by_name,
+        }
+        print("Scaling icons...")
+        for element in self.elements_by_name.values():
+            element.icons[False] = scale_icon(element.raw_icons[False])
+            if element.raw_icons[True] is element.raw_icons[False]:
+                element.icons[True] = element.icons[False]
+            else:
+                element.icons[True] = scale_icon(element.raw_icons[True])
+        self.elements_key = key
         print("Loaded elements!")
         
     def get_element_icon(self, el: Element, genderswap = False):
-        if type(el.image) is tuple:
-            el_table = el.image[0]
+        return el.raw_icons[genderswap]
+
+    def crop_icon(self, el: Element, genderswap = False):
+        if el.table is not None:
+            el_table = el.table
             if genderswap and el_table == "normal":
                 el_table = "genderswap"
-            return self.tables[el_table].crop((el.image[1][0] - 1, el.image[1][1] - 1, el.image[1][0] + config.element_size[0] + 1, el.image[1][1] + config.element_size[1] + 1))
+            x, y = el.coordinates
+            w, h = config.element_size
+            table = self.tables[el_table]
+            # Clamp the slice to the table (negative indices would wrap around),
+            # and leave whatever falls outside of it transparent, like Image.crop does
+            top, bottom = max(y - 1, 0), max(y + h + 1, 0)
+            left, right = max(x - 1, 0), max(x + w + 1, 0)
+            region = table[top:bottom, left:right]
+            icon = np.zeros((h + 2, w + 2, 4), dtype=np.uint8)
+            offset_y, offset_x = top - (y - 1), left - (x - 1)
+            icon[offset_y : offset_y + region.shape[0], offset_x : offset_x + region.shape[1]] = region
+            return Image.fromarray(icon, "RGBA")
         return el.image
     
-    def sync_image(self):
+    async def sync_image(self):
         print("Loading image...")
-        info = self.client.posts("elementcattos", id=config.post_id)
+        # pytumblr is synchronous, so keep its request off of the event loop
+        info = await asyncio.to_thread(self.client.posts, "elementcattos", id=config.post_id)
         table_post = info["posts"][0]
         table_data = table_post["trail"][0]
         table_content = table_data["content_raw"]
-        self.parser.reset()
-        self.parser.feed(table_content)
+        match = IMAGE_SRCSET.search(table_content)
+        assert match is not None, "Couldn't find the table's image!"
+        # Take the last (largest) candidate in the srcset
+        src = html.unescape(match.group(1)).split(", ")[-1].split(" ")[0]
+        async with aiohttp.ClientSession(raise_for_status=True) as session:
+            async with session.get(src) as response:
+                data = await response.read()
+        await asyncio.to_thread(save_table_image, data)
         print("Loaded image!")
     
     async def get_context(self, message: discord.Message, **kwargs) -> Context: